@@ -5,23 +5,31 @@ For use with Remnawave panel and Happ client
 """
 
 import os
-import json
-import copy
 import re
+import stat
 import asyncio
+import bisect
 import time
 import hashlib
+import logging
+from collections import OrderedDict
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 import httpx
+import orjson
+import xxhash
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse
-
-app = FastAPI(title="Subscription Proxy", version="1.0.0")
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
 # Configuration from environment
 UPSTREAM_URL = os.getenv("UPSTREAM_URL", "http://127.0.0.1:3010")
 BALANCER_NAME = os.getenv("BALANCER_NAME", "🇵🇱 Польша")
+# Legacy sticky mode hashes the balancer name into every HRW pick.
+BALANCER_NAME_BYTES = BALANCER_NAME.encode("utf-8", errors="ignore")
 PROBE_URL = os.getenv("PROBE_URL", "https://www.google.com/generate_204")
 PROBE_INTERVAL = os.getenv("PROBE_INTERVAL", "10s")
 FORWARDED_HOST = os.getenv("FORWARDED_HOST", "subs.pavuka.cv")
@@ -30,18 +38,46 @@ DEFAULT_GROUP_MODE = os.getenv("DEFAULT_GROUP_MODE", "sticky").strip().lower() o
 GROUP_RULES_PATH = os.getenv("GROUP_RULES_PATH", "").strip()
 UPSTREAM_RETRIES = max(1, int(os.getenv("UPSTREAM_RETRIES", "3")))
 UPSTREAM_RETRY_DELAY_MS = max(0, int(os.getenv("UPSTREAM_RETRY_DELAY_MS", "150")))
+# Linear backoff before each retry; None marks the last attempt (no retry after it).
+UPSTREAM_RETRY_DELAYS: tuple[float | None, ...] = tuple(
+    (UPSTREAM_RETRY_DELAY_MS / 1000.0) * (attempt + 1)
+    for attempt in range(UPSTREAM_RETRIES - 1)
+) + (None,)
 ASSET_COOKIE_SAFETY_MARGIN_SECONDS = max(
     0, int(os.getenv("ASSET_COOKIE_SAFETY_MARGIN_SECONDS", "15"))
 )
-
-PROXY_PROTOCOLS = {"vless", "vmess", "trojan", "shadowsocks"}
-IMPORTANT_HEADERS = [
+UPSTREAM_MAX_CONNECTIONS = max(1, int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "500")))
+UPSTREAM_MAX_KEEPALIVE = max(0, int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "200")))
+TRANSFORM_CACHE_SIZE = max(0, int(os.getenv("TRANSFORM_CACHE_SIZE", "1024")))
+# Passthrough bodies with a known length up to this size are buffered; larger
+# or unknown-length bodies are streamed to the client chunk by chunk.
+STREAM_MIN_BYTES = 64 * 1024
+# Happ bodies at least this large are rendered in a worker thread; for smaller
+# ones the thread hand-off costs more than the transform itself.
+TRANSFORM_THREAD_MIN_BYTES = 16 * 1024
+# How often (seconds) to re-check GROUP_RULES_PATH for changes.
+GROUP_RULES_STAT_INTERVAL = 1.0
+
+PROXY_PROTOCOLS = frozenset({"vless", "vmess", "trojan", "shadowsocks"})
+SET_COOKIE_RE = re.compile(r"([^;]*=[^;]*)(?:;.*?\bmax-age=(\d+)\b)?", re.IGNORECASE)
+# First byte after JSON whitespace; lets us peek without copying the body.
+JSON_FIRST_TOKEN_RE = re.compile(rb"[^ \t\r\n]")
+IMPORTANT_HEADERS = (
     "profile-title",
     "profile-update-interval",
     "subscription-userinfo",
     "profile-web-page-url",
     "support-url",
-]
+)
+RETRYABLE_UPSTREAM_ERRORS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.ReadError,
+    httpx.ReadTimeout,
+    httpx.RemoteProtocolError,
+    httpx.WriteError,
+    httpx.WriteTimeout,
+)
 HOP_BY_HOP_HEADERS = {
     "connection",
     "keep-alive",
@@ -63,33 +99,130 @@ DECODE_SENSITIVE_HEADERS = {
     "content-encoding",
     "content-length",
 }
+# Upstream response headers never relayed to the client.
+EXCLUDED_RESPONSE_HEADERS = frozenset(
+    HOP_BY_HOP_HEADERS | PROXY_GENERATED_RESPONSE_HEADERS | DECODE_SENSITIVE_HEADERS
+)
+# Request headers that are the same for every upstream call.
+UPSTREAM_STATIC_HEADERS = {
+    "Host": FORWARDED_HOST,
+    # Avoid upstream compression to prevent Content-Encoding/body mismatches.
+    "Accept-Encoding": "identity",
+    "X-Forwarded-Proto": "https",
+    "X-Forwarded-Host": FORWARDED_HOST,
+    "X-Forwarded-Port": "443",
+}
+# Shared reply for any upstream failure; the exception text stays in the log.
+UPSTREAM_ERROR_RESPONSE = Response(status_code=502, content=b"Upstream error")
+
+logger = logging.getLogger("subscription-proxy")
+
+# Client request headers copied to upstream only when present.
+FORWARDED_OPTIONAL_HEADERS = ("Cookie", "Referer")
+# Static parts of the generated balancer config. They are shared by reference
+# between builds (the result is serialized right away and never mutated).
+DEFAULT_DNS = {
+    "servers": ["1.1.1.1", "1.0.0.1"],
+    "queryStrategy": "UseIP",
+}
+DEFAULT_INBOUNDS = [
+    {
+        "tag": "socks",
+        "port": 10808,
+        "listen": "127.0.0.1",
+        "protocol": "socks",
+        "settings": {"udp": True, "auth": "noauth"},
+        "sniffing": {
+            "enabled": True,
+            "routeOnly": False,
+            "destOverride": ["http", "tls", "quic"],
+        },
+    },
+    {
+        "tag": "http",
+        "port": 10809,
+        "listen": "127.0.0.1",
+        "protocol": "http",
+        "settings": {"allowTransparent": False},
+        "sniffing": {
+            "enabled": True,
+            "routeOnly": False,
+            "destOverride": ["http", "tls", "quic"],
+        },
+    },
+]
+BALANCER_EXTRA_OUTBOUNDS = (
+    {"tag": "direct", "protocol": "freedom"},
+    {"tag": "block", "protocol": "blackhole"},
+)
+BALANCER_ROUTING_RULES = [
+    {
+        "type": "field",
+        "protocol": ["bittorrent"],
+        "outboundTag": "direct",
+    },
+    {
+        "type": "field",
+        "network": "tcp,udp",
+        "balancerTag": "balancer",
+    },
+]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One shared client per process: keeps upstream connections alive between
+    # requests instead of paying a new TCP handshake for every subscription fetch.
+    app.state.http = httpx.AsyncClient(
+        base_url=UPSTREAM_URL,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            keepalive_expiry=30.0,
+        ),
+        # Negotiated via ALPN, so it only kicks in for an https:// UPSTREAM_URL.
+        http2=True,
+        # The client is shared by all users: a cookie jar would replay one
+        # user's upstream Set-Cookie on everybody else's requests. Cookies are
+        # only ever forwarded explicitly from the incoming request.
+        cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(title="Subscription Proxy", version="1.0.0", lifespan=lifespan)
 
 _group_rules_cache: dict[str, Any] = {
     "path": None,
     "mtime": None,
     "rules": [],
+    "stat_checked_at": float("-inf"),
+    # Bumped whenever the loaded rules change; part of the transform cache key.
+    "version": 0,
 }
 _asset_cookie_cache: dict[str, Any] = {
     "cookie": None,
     "expires_at": 0.0,
 }
+# LRU of rendered Happ bodies: key -> (content or None if unchanged, is_json).
+_transform_cache: OrderedDict[tuple, tuple[bytes | None, bool]] = OrderedDict()
 
 
 def _cache_asset_cookie_from_set_cookie(set_cookie_value: str) -> None:
     if not set_cookie_value:
         return
 
-    cookie = set_cookie_value.split(";", 1)[0].strip()
-    if not cookie or "=" not in cookie:
+    # One scan: "name=value" before the first ";" plus an optional Max-Age.
+    m = SET_COOKIE_RE.match(set_cookie_value)
+    if not m:
         return
 
-    max_age_seconds: int | None = None
-    m = re.search(r"(?i)\\bmax-age=(\\d+)\\b", set_cookie_value)
-    if m:
-        try:
-            max_age_seconds = int(m.group(1))
-        except ValueError:
-            max_age_seconds = None
+    cookie = m.group(1).strip()
+    max_age_seconds = int(m.group(2)) if m.group(2) else None
 
     now = time.time()
     if max_age_seconds is not None and max_age_seconds > 0:
@@ -110,56 +243,59 @@ def _get_cached_asset_cookie() -> str | None:
     return cookie
 
 
+def _get_cached_transform(key: tuple) -> tuple[bytes | None, bool] | None:
+    entry = _transform_cache.get(key)
+    if entry is not None:
+        _transform_cache.move_to_end(key)
+    return entry
+
+
+def _cache_transform(key: tuple, entry: tuple[bytes | None, bool]) -> None:
+    if TRANSFORM_CACHE_SIZE <= 0:
+        return
+    _transform_cache[key] = entry
+    _transform_cache.move_to_end(key)
+    while len(_transform_cache) > TRANSFORM_CACHE_SIZE:
+        _transform_cache.popitem(last=False)
+
+
 def _extract_subscription_headers(upstream_response: httpx.Response) -> dict[str, str]:
-    headers: dict[str, str] = {}
-    for header_name in IMPORTANT_HEADERS:
-        if header_name in upstream_response.headers:
-            headers[header_name] = upstream_response.headers[header_name]
-    return headers
+    upstream_headers = upstream_response.headers
+    return {
+        name: upstream_headers[name]
+        for name in IMPORTANT_HEADERS
+        if name in upstream_headers
+    }
 
 
 def _extract_passthrough_headers(upstream_response: httpx.Response) -> dict[str, str]:
-    headers: dict[str, str] = {}
-    for key, value in upstream_response.headers.items():
-        lower_key = key.lower()
-        if lower_key in HOP_BY_HOP_HEADERS:
-            continue
-        if lower_key in PROXY_GENERATED_RESPONSE_HEADERS:
-            continue
-        if lower_key in DECODE_SENSITIVE_HEADERS:
-            continue
-        headers[key] = value
-    return headers
+    return {
+        key: value
+        for key, value in upstream_response.headers.items()
+        if key.lower() not in EXCLUDED_RESPONSE_HEADERS
+    }
 
 
 def _build_upstream_request_headers(
     request: Request, *, force_accept_html: bool = False
 ) -> dict[str, str]:
-    accept = request.headers.get("Accept", "*/*")
+    request_headers = request.headers
+    accept = request_headers.get("Accept", "*/*")
     if force_accept_html and (not accept or accept.strip() == "*/*"):
         accept = "text/html"
 
-    headers = {
-        "Host": FORWARDED_HOST,
-        "User-Agent": request.headers.get("User-Agent", ""),
+    client = request.client
+    headers = UPSTREAM_STATIC_HEADERS | {
+        "User-Agent": request_headers.get("User-Agent", ""),
         "Accept": accept,
-        # Avoid upstream compression to prevent Content-Encoding/body mismatches.
-        "Accept-Encoding": "identity",
-        "Connection": "close",
-        "X-Forwarded-Proto": "https",
-        "X-Forwarded-Host": FORWARDED_HOST,
-        "X-Forwarded-Port": "443",
-        "X-Forwarded-For": request.client.host if request.client else "127.0.0.1",
+        "X-Forwarded-For": client.host if client else "127.0.0.1",
     }
 
-    # Required for subscription-page static assets and session validation.
-    cookie = request.headers.get("Cookie")
-    if cookie:
-        headers["Cookie"] = cookie
-
-    referer = request.headers.get("Referer")
-    if referer:
-        headers["Referer"] = referer
+    # Cookie is required for subscription-page static assets and session validation.
+    for name in FORWARDED_OPTIONAL_HEADERS:
+        value = request_headers.get(name)
+        if value:
+            headers[name] = value
 
     return headers
 
@@ -175,46 +311,53 @@ def _inject_cookie_if_missing(headers: dict[str, str], cookie: str | None) -> No
 
 
 def _build_upstream_url(path: str, request: Request) -> str:
-    normalized_path = path.lstrip("/")
-    base = UPSTREAM_URL.rstrip("/")
-    target = f"{base}/{normalized_path}" if normalized_path else base
+    # Relative to the shared client's base_url (UPSTREAM_URL).
+    target = "/" + path.lstrip("/")
     if request.url.query:
         return f"{target}?{request.url.query}"
     return target
 
 
+def _is_small_body(response: httpx.Response) -> bool:
+    content_length = response.headers.get("content-length", "")
+    return content_length.isdigit() and int(content_length) <= STREAM_MIN_BYTES
+
+
 async def _request_upstream_with_retries(
     client: httpx.AsyncClient,
     method: str,
     url: str,
     headers: dict[str, str],
+    *,
+    stream: bool = False,
 ) -> httpx.Response:
+    """
+    With stream=True only small bodies (see _is_small_body) are read here, so a
+    failure mid-body is retried; the caller must aclose() the response.
+    """
     last_error: Exception | None = None
+    # GET/HEAD without a body: the same request object can be re-sent.
+    upstream_request = client.build_request(method, url, headers=headers)
 
-    for attempt in range(UPSTREAM_RETRIES):
+    for delay in UPSTREAM_RETRY_DELAYS:
         try:
-            response = await client.request(
-                method,
-                url,
-                headers=headers,
-                timeout=30.0,
-            )
-            if response.status_code >= 500 and attempt < (UPSTREAM_RETRIES - 1):
-                await asyncio.sleep((UPSTREAM_RETRY_DELAY_MS / 1000.0) * (attempt + 1))
+            response = await client.send(upstream_request, stream=stream)
+            if response.status_code >= 500 and delay is not None:
+                # Release the connection back to the pool before retrying.
+                await response.aclose()
+                await asyncio.sleep(delay)
                 continue
+            if stream and _is_small_body(response):
+                try:
+                    await response.aread()
+                except RETRYABLE_UPSTREAM_ERRORS:
+                    await response.aclose()
+                    raise
             return response
-        except (
-            httpx.ConnectError,
-            httpx.ConnectTimeout,
-            httpx.ReadError,
-            httpx.ReadTimeout,
-            httpx.RemoteProtocolError,
-            httpx.WriteError,
-            httpx.WriteTimeout,
-        ) as exc:
+        except RETRYABLE_UPSTREAM_ERRORS as exc:
             last_error = exc
-            if attempt < (UPSTREAM_RETRIES - 1):
-                await asyncio.sleep((UPSTREAM_RETRY_DELAY_MS / 1000.0) * (attempt + 1))
+            if delay is not None:
+                await asyncio.sleep(delay)
                 continue
             raise
 
@@ -224,41 +367,34 @@ async def _request_upstream_with_retries(
 
 
 def _extract_proxy_outbound(config: dict) -> dict | None:
-    for outbound in config.get("outbounds", []):
-        if outbound.get("protocol") in PROXY_PROTOCOLS:
-            return outbound
-    return None
+    return next(
+        (
+            outbound
+            for outbound in config.get("outbounds") or ()
+            if outbound.get("protocol") in PROXY_PROTOCOLS
+        ),
+        None,
+    )
 
 
 def _extract_outbound_address(outbound: dict | None) -> str:
     if not isinstance(outbound, dict):
         return ""
 
-    settings = outbound.get("settings", {})
+    settings = outbound.get("settings")
     if not isinstance(settings, dict):
         return ""
 
-    vnext = settings.get("vnext")
-    if isinstance(vnext, list) and vnext:
-        first = vnext[0]
-        if isinstance(first, dict):
-            address = first.get("address")
-            if isinstance(address, str):
-                return address
-
-    servers = settings.get("servers")
-    if isinstance(servers, list) and servers:
-        first = servers[0]
-        if isinstance(first, dict):
-            address = first.get("address")
+    # vless/vmess: settings.vnext[0].address, trojan/ss: settings.servers[0].address
+    for key in ("vnext", "servers"):
+        entries = settings.get(key)
+        if entries and isinstance(entries, list) and isinstance(entries[0], dict):
+            address = entries[0].get("address")
             if isinstance(address, str):
                 return address
 
     address = settings.get("address")
-    if isinstance(address, str):
-        return address
-
-    return ""
+    return address if isinstance(address, str) else ""
 
 
 def _extract_outbound_user_key(outbound: dict | None) -> str:
@@ -301,24 +437,52 @@ def _extract_outbound_user_key(outbound: dict | None) -> str:
     return ""
 
 
-def _derive_assignment_key(configs: list[dict], short_uuid: str, request: Request) -> str:
+def _index_configs(configs: list) -> list[dict]:
+    """
+    Walk every config once and keep what grouping needs:
+    idx, config, remark, proxy outbound, address and the HRW node key (bytes).
+    """
+    indexed = []
+    for idx, config in enumerate(configs):
+        if isinstance(config, dict):
+            outbound = _extract_proxy_outbound(config)
+            remark = config.get("remarks", "")
+        else:
+            outbound = None
+            remark = ""
+        address = _extract_outbound_address(outbound)
+
+        node_key = (address or str(remark or "")).encode("utf-8", errors="ignore")
+        if not node_key:
+            # Last-resort, but keep deterministic-ish.
+            node_key = orjson.dumps(config, option=orjson.OPT_SORT_KEYS)[:64]
+
+        indexed.append(
+            {
+                "idx": idx,
+                "config": config,
+                "remark": remark,
+                "outbound": outbound,
+                "address": address,
+                "node_key": node_key,
+            }
+        )
+    return indexed
+
+
+def _derive_assignment_key(indexed: list[dict], fallback_key: str) -> str:
     """
     Stable key used for per-user node assignment inside a group.
-    Prefer user's UUID/password from the subscription config, then fall back to short_uuid.
+    Prefer user's UUID/password from the subscription config, then fall back to
+    fallback_key (short_uuid, or client host when short_uuid is empty).
     """
-    for cfg in configs:
-        if not isinstance(cfg, dict):
-            continue
-        outbound = _extract_proxy_outbound(cfg)
-        key = _extract_outbound_user_key(outbound)
+    for item in indexed:
+        key = _extract_outbound_user_key(item["outbound"])
         if key:
             return key
 
-    if short_uuid:
-        return short_uuid
-
-    if request.client and request.client.host:
-        return request.client.host
+    if fallback_key:
+        return fallback_key
 
     return "anonymous"
 
@@ -340,52 +504,96 @@ def _normalize_group_mode(value: str | None) -> str:
 def _hrw_pick_config(
     candidates: list[dict],
     *,
-    assignment_key: str,
-    group_name: str,
+    assignment_key: bytes,
+    group_name: bytes,
 ) -> dict:
     """
     Pick one config deterministically for this user (Rendezvous/HRW hashing).
     This gives near-even distribution and minimal churn when nodes are added/removed.
+    Candidates are _index_configs() entries; the picked config is returned.
+    Both keys come pre-encoded so this stays free of per-call str.encode().
     """
     best_cfg: dict | None = None
     best_score: int = -1
 
-    for cfg in candidates:
-        outbound = _extract_proxy_outbound(cfg)
-        node_key = _extract_outbound_address(outbound) or str(cfg.get("remarks") or "")
-        if not node_key:
-            # Last-resort, but keep deterministic-ish.
-            node_key = json.dumps(cfg, sort_keys=True)[:64]
-
-        h = hashlib.blake2s(digest_size=8)
-        h.update(assignment_key.encode("utf-8", errors="ignore"))
-        h.update(b"|")
-        h.update(group_name.encode("utf-8", errors="ignore"))
-        h.update(b"|")
-        h.update(node_key.encode("utf-8", errors="ignore"))
+    # The "<user>|<group>|" prefix is the same for every candidate: hash it once
+    # and only feed the node key into a copy of that state.
+    prefix = hashlib.blake2s(digest_size=8)
+    prefix.update(assignment_key)
+    prefix.update(b"|")
+    prefix.update(group_name)
+    prefix.update(b"|")
+
+    for item in candidates:
+        h = prefix.copy()
+        h.update(item["node_key"])
         score = int.from_bytes(h.digest(), "big")
 
         if score > best_score:
             best_score = score
-            best_cfg = cfg
+            best_cfg = item["config"]
 
     if best_cfg is None:
         # Should never happen (len>=1), but keep it safe.
-        return candidates[0]
+        return candidates[0]["config"]
 
     return best_cfg
 
 
+def _compile_patterns(patterns: list[str]) -> tuple[re.Pattern[str], ...]:
+    """
+    Compile rule patterns into as few regexes as possible.
+    Valid patterns are fused into one alternation so a match is a single search;
+    if fusing is not safe (group references, inline global flags), keep them separate.
+    """
+    compiled: list[re.Pattern[str]] = []
+    for pattern in patterns:
+        try:
+            compiled.append(re.compile(pattern, re.IGNORECASE))
+        except re.error:
+            # Broken pattern in rules file - skip it, keep the rest of the rule.
+            continue
+
+    # Fusing renumbers the groups of every pattern after the first, which breaks
+    # \N backreferences and (?(N)yes|no) conditionals; keep those separate.
+    if len(compiled) < 2 or any(p.groups for p in compiled[1:]):
+        return tuple(compiled)
+
+    try:
+        combined = re.compile(
+            "|".join(f"(?:{p.pattern})" for p in compiled), re.IGNORECASE
+        )
+    except re.error:
+        return tuple(compiled)
+    return (combined,)
+
+
+def _store_group_rules(path: str, mtime: float | None, rules: list[dict]) -> list[dict]:
+    if (_group_rules_cache["path"], _group_rules_cache["mtime"]) != (path, mtime):
+        _group_rules_cache["version"] += 1
+    _group_rules_cache.update({"path": path, "mtime": mtime, "rules": rules})
+    return rules
+
+
 def _load_group_rules() -> list[dict]:
     if not GROUP_RULES_PATH:
         return []
 
+    # The rules file rarely changes: stat it at most once per interval.
+    now = time.monotonic()
+    if now - _group_rules_cache["stat_checked_at"] < GROUP_RULES_STAT_INTERVAL:
+        return _group_rules_cache["rules"]
+    _group_rules_cache["stat_checked_at"] = now
+
     path = Path(GROUP_RULES_PATH)
-    if not path.exists() or not path.is_file():
-        return []
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return _store_group_rules(str(path), None, [])
 
-    stat = path.stat()
-    mtime = stat.st_mtime
+    mtime = st.st_mtime
     if (
         _group_rules_cache["path"] == str(path)
         and _group_rules_cache["mtime"] == mtime
@@ -393,10 +601,9 @@ def _load_group_rules() -> list[dict]:
         return _group_rules_cache["rules"]
 
     try:
-        raw = json.loads(path.read_text(encoding="utf-8"))
-    except (OSError, json.JSONDecodeError):
-        _group_rules_cache.update({"path": str(path), "mtime": mtime, "rules": []})
-        return []
+        raw = orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return _store_group_rules(str(path), mtime, [])
 
     if isinstance(raw, dict):
         raw_rules = raw.get("groups", [])
@@ -428,13 +635,16 @@ def _load_group_rules() -> list[dict]:
         normalized.append(
             {
                 "name": name.strip(),
-                "remarks": [x for x in remarks if isinstance(x, str) and x.strip()],
-                "remark_regex": [
-                    x for x in remark_regex if isinstance(x, str) and x.strip()
-                ],
-                "address_regex": [
-                    x for x in address_regex if isinstance(x, str) and x.strip()
-                ],
+                "name_bytes": name.strip().encode("utf-8", errors="ignore"),
+                "remarks": frozenset(
+                    x for x in remarks if isinstance(x, str) and x.strip()
+                ),
+                "remark_regex": _compile_patterns(
+                    [x for x in remark_regex if isinstance(x, str) and x.strip()]
+                ),
+                "address_regex": _compile_patterns(
+                    [x for x in address_regex if isinstance(x, str) and x.strip()]
+                ),
                 "mode": _normalize_group_mode(
                     item.get("mode") if isinstance(item.get("mode"), str) else None
                 ),
@@ -452,33 +662,99 @@ def _load_group_rules() -> list[dict]:
             }
         )
 
-    _group_rules_cache.update({"path": str(path), "mtime": mtime, "rules": normalized})
-    return normalized
+    return _store_group_rules(str(path), mtime, normalized)
 
 
-def _rule_matches(rule: dict, remark: str, address: str) -> bool:
-    if remark in rule["remarks"]:
-        return True
-
+def _rule_regex_matches(rule: dict, remark: str, address: str) -> bool:
     for pattern in rule["remark_regex"]:
-        try:
-            if re.search(pattern, remark, flags=re.IGNORECASE):
-                return True
-        except re.error:
-            continue
+        if pattern.search(remark):
+            return True
 
     for pattern in rule["address_regex"]:
-        try:
-            if re.search(pattern, address, flags=re.IGNORECASE):
-                return True
-        except re.error:
-            continue
+        if pattern.search(address):
+            return True
 
     return False
 
 
+def _item_idx(item: dict) -> int:
+    return item["idx"]
+
+
+def _index_rules(rules: list[dict]) -> tuple[dict[str, list[int]], list[int]]:
+    """
+    Inverted index over exact remarks (remark -> ascending rule indices), plus the
+    indices of rules with regexes, which still have to be tested one by one.
+    """
+    by_remark: dict[str, list[int]] = {}
+    regex_rules: list[int] = []
+    for r_idx, rule in enumerate(rules):
+        for remark in rule["remarks"]:
+            by_remark.setdefault(remark, []).append(r_idx)
+        if rule["remark_regex"] or rule["address_regex"]:
+            regex_rules.append(r_idx)
+    return by_remark, regex_rules
+
+
+def _next_matching_rule(
+    rules: list[dict],
+    rule_index: tuple[dict[str, list[int]], list[int]],
+    item: dict,
+    start: int,
+) -> int:
+    """Index of the first rule at or after start that matches item, or -1."""
+    by_remark, regex_rules = rule_index
+
+    exact = by_remark.get(item["remark"], ())
+    pos = bisect.bisect_left(exact, start)
+    best = exact[pos] if pos < len(exact) else -1
+
+    # Only a regex rule ordered before the exact hit can take the config.
+    for r_idx in regex_rules[bisect.bisect_left(regex_rules, start):]:
+        if best >= 0 and r_idx >= best:
+            break
+        if _rule_regex_matches(rules[r_idx], item["remark"], item["address"]):
+            return r_idx
+
+    return best
+
+
+def _build_rule_group(
+    rule: dict,
+    matched: list[dict],
+    *,
+    assignment_key: bytes,
+) -> dict | None:
+    if len(matched) < 2:
+        return None
+
+    mode = rule.get("mode")
+    if not isinstance(mode, str):
+        mode = DEFAULT_GROUP_MODE
+    mode = _normalize_group_mode(mode)
+
+    if mode == "xray_balancer":
+        return build_balancer_config(
+            [item["config"] for item in matched],
+            balancer_name=rule["name"],
+            strategy=rule.get("strategy") or DEFAULT_BALANCER_STRATEGY,
+            probe_url=rule.get("probe_url") or PROBE_URL,
+            probe_interval=rule.get("probe_interval") or PROBE_INTERVAL,
+            proxy_outbounds=[item["outbound"] for item in matched],
+        )
+
+    picked = _hrw_pick_config(
+        matched,
+        assignment_key=assignment_key,
+        group_name=rule["name_bytes"],
+    )
+    # Only the top-level remarks changes; nested parts stay shared with the
+    # parsed subscription, which is serialized and dropped right after.
+    return {**picked, "remarks": rule["name"]}
+
+
 def _transform_configs_with_rules(
-    configs: list[dict],
+    indexed: list[dict],
     rules: list[dict],
     *,
     assignment_key: str,
@@ -486,73 +762,62 @@ def _transform_configs_with_rules(
     if not rules:
         return []
 
-    indexed = []
-    for idx, config in enumerate(configs):
-        outbound = _extract_proxy_outbound(config)
-        indexed.append(
-            {
-                "idx": idx,
-                "config": config,
-                "remark": config.get("remarks", "") if isinstance(config, dict) else "",
-                "address": _extract_outbound_address(outbound),
-            }
-        )
-
-    consumed: set[int] = set()
-    output: list[tuple[int, dict]] = []
+    rule_index = _index_rules(rules)
+    # Every sticky rule hashes the same user key: encode it once per render.
+    assignment_key_bytes = assignment_key.encode("utf-8", errors="ignore")
 
-    for rule in rules:
-        matched = [
-            item
-            for item in indexed
-            if item["idx"] not in consumed
-            and _rule_matches(rule, item["remark"], item["address"])
-        ]
+    # Single pass over configs: each one lands in the bucket of the first rule
+    # it matches. Buckets stay ordered by idx.
+    buckets: list[list[dict]] = [[] for _ in rules]
+    for item in indexed:
+        r_idx = _next_matching_rule(rules, rule_index, item, 0)
+        if r_idx >= 0:
+            buckets[r_idx].append(item)
+
+    # idx is dense (0..n-1), so a flag list beats hashing into a set.
+    consumed = [False] * len(indexed)
+    # Group result keyed by the idx of its first member: that is where it goes.
+    groups_at: dict[int, dict] = {}
+
+    for r_idx, rule in enumerate(rules):
+        matched = buckets[r_idx]
+        grouped = _build_rule_group(
+            rule, matched, assignment_key=assignment_key_bytes
+        )
 
-        if len(matched) < 2:
+        if grouped is None:
+            # The rule did not form a group, so its configs stay available for
+            # later rules, exactly as if this rule had never matched them.
+            for item in matched:
+                next_idx = _next_matching_rule(rules, rule_index, item, r_idx + 1)
+                if next_idx >= 0:
+                    bisect.insort(buckets[next_idx], item, key=_item_idx)
             continue
 
-        mode = rule.get("mode")
-        if not isinstance(mode, str):
-            mode = DEFAULT_GROUP_MODE
-        mode = _normalize_group_mode(mode)
-
-        group_configs = [item["config"] for item in matched]
-
-        if mode == "xray_balancer":
-            grouped = build_balancer_config(
-                group_configs,
-                balancer_name=rule["name"],
-                strategy=rule.get("strategy") or DEFAULT_BALANCER_STRATEGY,
-                probe_url=rule.get("probe_url") or PROBE_URL,
-                probe_interval=rule.get("probe_interval") or PROBE_INTERVAL,
-            )
-            if not grouped:
-                continue
-        else:
-            picked = _hrw_pick_config(
-                group_configs,
-                assignment_key=assignment_key,
-                group_name=rule["name"],
-            )
-            grouped = copy.deepcopy(picked)
-            grouped["remarks"] = rule["name"]
-
         for item in matched:
-            consumed.add(item["idx"])
+            consumed[item["idx"]] = True
 
-        first_idx = min(item["idx"] for item in matched)
-        output.append((first_idx, grouped))
+        groups_at[matched[0]["idx"]] = grouped
 
-    if not output:
+    if not groups_at:
         return []
 
+    # indexed is already in upstream order: one pass, no sort.
+    output: list[dict] = []
     for item in indexed:
-        if item["idx"] not in consumed:
-            output.append((item["idx"], item["config"]))
+        idx = item["idx"]
+        if idx in groups_at:
+            output.append(groups_at[idx])
+        elif not consumed[idx]:
+            output.append(item["config"])
+    return output
 
-    output.sort(key=lambda x: x[0])
-    return [item[1] for item in output]
+
+@lru_cache(maxsize=64)
+def _outbound_tags(count: int) -> tuple[str, ...]:
+    # Keep the first outbound tag as "proxy" for client compatibility
+    # (some clients expect a canonical proxy tag for latency test UI).
+    return ("proxy", *(f"proxy_{i + 1}" for i in range(1, count)))
 
 
 def build_balancer_config(
@@ -561,73 +826,43 @@ def build_balancer_config(
     strategy: str = DEFAULT_BALANCER_STRATEGY,
     probe_url: str = PROBE_URL,
     probe_interval: str = PROBE_INTERVAL,
+    *,
+    proxy_outbounds: list[dict | None] | None = None,
 ) -> dict | None:
-    """Build single xray config with balancer from multiple configs"""
+    """
+    Build single xray config with balancer from multiple configs.
+    proxy_outbounds may carry the already extracted proxy outbound of each config
+    (same order) to avoid scanning their outbounds again.
+    """
 
     if not configs or len(configs) < 2:
         return None
 
-    # Use first config as base
-    base = copy.deepcopy(configs[0])
+    # Use first config as base (dns/inbounds are only read, never mutated)
+    base = configs[0]
 
     outbounds = []
     balancer_selectors = []
 
-    # Extract proxy outbounds from each config
-    for i, config in enumerate(configs):
-        # Keep the first outbound tag as "proxy" for client compatibility
-        # (some clients expect a canonical proxy tag for latency test UI).
-        tag = "proxy" if i == 0 else f"proxy_{i+1}"
+    if proxy_outbounds is None:
+        proxy_outbounds = [_extract_proxy_outbound(config) for config in configs]
 
-        outbound = _extract_proxy_outbound(config)
+    for tag, outbound in zip(_outbound_tags(len(proxy_outbounds)), proxy_outbounds):
         if outbound:
-            new_outbound = copy.deepcopy(outbound)
-            new_outbound["tag"] = tag
-            outbounds.append(new_outbound)
+            outbounds.append({**outbound, "tag": tag})
             balancer_selectors.append(tag)
 
     if len(outbounds) < 2:
         return None
 
     # Add direct and block outbounds
-    outbounds.extend([
-        {"tag": "direct", "protocol": "freedom"},
-        {"tag": "block", "protocol": "blackhole"}
-    ])
+    outbounds.extend(BALANCER_EXTRA_OUTBOUNDS)
 
     # Build final config
     final_config = {
         "remarks": balancer_name,
-        "dns": base.get("dns", {
-            "servers": ["1.1.1.1", "1.0.0.1"],
-            "queryStrategy": "UseIP"
-        }),
-        "inbounds": base.get("inbounds", [
-            {
-                "tag": "socks",
-                "port": 10808,
-                "listen": "127.0.0.1",
-                "protocol": "socks",
-                "settings": {"udp": True, "auth": "noauth"},
-                "sniffing": {
-                    "enabled": True,
-                    "routeOnly": False,
-                    "destOverride": ["http", "tls", "quic"]
-                }
-            },
-            {
-                "tag": "http",
-                "port": 10809,
-                "listen": "127.0.0.1",
-                "protocol": "http",
-                "settings": {"allowTransparent": False},
-                "sniffing": {
-                    "enabled": True,
-                    "routeOnly": False,
-                    "destOverride": ["http", "tls", "quic"]
-                }
-            }
-        ]),
+        "dns": base.get("dns", DEFAULT_DNS),
+        "inbounds": base.get("inbounds", DEFAULT_INBOUNDS),
         "outbounds": outbounds,
         "routing": {
             "domainMatcher": "hybrid",
@@ -641,18 +876,7 @@ def build_balancer_config(
                     }
                 }
             ],
-            "rules": [
-                {
-                    "type": "field",
-                    "protocol": ["bittorrent"],
-                    "outboundTag": "direct"
-                },
-                {
-                    "type": "field",
-                    "network": "tcp,udp",
-                    "balancerTag": "balancer"
-                }
-            ]
+            "rules": BALANCER_ROUTING_RULES,
         },
         "observatory": {
             "subjectSelector": balancer_selectors,
@@ -665,6 +889,102 @@ def build_balancer_config(
     return final_config
 
 
+def _render_happ_body(
+    body: bytes,
+    group_rules: list[dict],
+    fallback_key: str,
+) -> tuple[bytes, bool]:
+    """
+    Transform a Happ subscription body.
+    Returns (content, is_json); content is the original body when nothing changes.
+    """
+    try:
+        configs = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        # Not JSON - return as is
+        return body, False
+
+    if not isinstance(configs, list):
+        # Non-list JSON - return as is
+        return body, True
+
+    # Rules mode: if GROUP_RULES_PATH is configured, use selective grouping only.
+    if GROUP_RULES_PATH:
+        if not group_rules:
+            return body, True
+        indexed = _index_configs(configs)
+        assignment_key = _derive_assignment_key(indexed, fallback_key)
+        transformed = _transform_configs_with_rules(
+            indexed,
+            group_rules,
+            assignment_key=assignment_key,
+        )
+        if transformed:
+            return orjson.dumps(transformed), True
+        # Nothing grouped: the upstream bytes already are the answer.
+        return body, True
+
+    # Legacy mode: if no rules configured, merge all into one entry.
+    if len(configs) > 1:
+        mode = _normalize_group_mode(DEFAULT_GROUP_MODE)
+        if mode == "xray_balancer":
+            balancer_config = build_balancer_config(
+                configs,
+                balancer_name=BALANCER_NAME,
+                strategy=DEFAULT_BALANCER_STRATEGY,
+                probe_url=PROBE_URL,
+                probe_interval=PROBE_INTERVAL,
+            )
+            if balancer_config:
+                return orjson.dumps([balancer_config]), True
+        else:
+            indexed = _index_configs(configs)
+            assignment_key = _derive_assignment_key(indexed, fallback_key)
+            picked = _hrw_pick_config(
+                indexed,
+                assignment_key=assignment_key.encode("utf-8", errors="ignore"),
+                group_name=BALANCER_NAME_BYTES,
+            )
+            grouped = {**picked, "remarks": BALANCER_NAME}
+            return orjson.dumps([grouped]), True
+
+    return body, True
+
+
+async def _passthrough_response(
+    upstream_response: httpx.Response,
+    *,
+    default_media_type: str | None = None,
+) -> Response:
+    """Relay a streamed upstream response; small bodies are sent in one piece."""
+    status_code = upstream_response.status_code
+    media_type = upstream_response.headers.get("content-type", default_media_type)
+    headers = _extract_passthrough_headers(upstream_response)
+
+    if _is_small_body(upstream_response):
+        try:
+            # Already read by _request_upstream_with_retries; no network I/O here.
+            content = await upstream_response.aread()
+        finally:
+            await upstream_response.aclose()
+        return Response(
+            content=content,
+            status_code=status_code,
+            media_type=media_type,
+            headers=headers,
+        )
+
+    # aiter_bytes (not aiter_raw): Content-Encoding is stripped from the
+    # relayed headers, so the body must be the decoded one.
+    return StreamingResponse(
+        upstream_response.aiter_bytes(),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+        background=BackgroundTask(upstream_response.aclose),
+    )
+
+
 @app.get("/health")
 async def health():
     """Health check endpoint"""
@@ -679,26 +999,41 @@ async def proxy_subscription(short_uuid: str, request: Request):
 
     # Only transform for Happ clients
     is_happ = "Happ" in user_agent
+    # HEAD and non-Happ clients must be proxied as-is with full headers/cookies,
+    # so their body is relayed without buffering.
+    passthrough = request.method != "GET" or not is_happ
 
-    async with httpx.AsyncClient() as client:
-        try:
-            upstream_response = await _request_upstream_with_retries(
-                client,
-                request.method,
-                _build_upstream_url(short_uuid, request),
-                _build_upstream_request_headers(
-                    request,
-                    force_accept_html=not is_happ,
-                ),
-            )
-        except Exception as e:
-            return Response(status_code=502, content=f"Upstream error: {e}")
+    client: httpx.AsyncClient = request.app.state.http
+    try:
+        upstream_response = await _request_upstream_with_retries(
+            client,
+            request.method,
+            _build_upstream_url(short_uuid, request),
+            _build_upstream_request_headers(
+                request,
+                force_accept_html=not is_happ,
+            ),
+            stream=passthrough,
+        )
+    except Exception:
+        logger.exception(
+            "upstream request failed: %s %s", request.method, request.url.path
+        )
+        return UPSTREAM_ERROR_RESPONSE
 
     # Cache session cookie from the HTML page response for later /assets requests.
-    for v in upstream_response.headers.get_list("set-cookie"):
-        _cache_asset_cookie_from_set_cookie(v)
-        break
-    
+    set_cookies = upstream_response.headers.get_list("set-cookie")
+    if set_cookies:
+        _cache_asset_cookie_from_set_cookie(set_cookies[0])
+
+    if passthrough:
+        return await _passthrough_response(
+            upstream_response,
+            default_media_type=(
+                "text/plain" if upstream_response.status_code == 200 else None
+            ),
+        )
+
     if upstream_response.status_code != 200:
         return Response(
             status_code=upstream_response.status_code,
@@ -707,105 +1042,130 @@ async def proxy_subscription(short_uuid: str, request: Request):
             headers=_extract_passthrough_headers(upstream_response),
         )
 
-    # HEAD and non-Happ clients must be proxied as-is with full headers/cookies.
-    if request.method != "GET" or not is_happ:
-        return Response(
-            content=upstream_response.content,
-            status_code=upstream_response.status_code,
-            media_type=upstream_response.headers.get("content-type", "text/plain"),
-            headers=_extract_passthrough_headers(upstream_response),
-        )
-
     response_headers = _extract_subscription_headers(upstream_response)
+    body = upstream_response.content
 
-    # Try to parse and transform JSON
-    try:
-        configs = json.loads(upstream_response.text)
-
-        if isinstance(configs, list):
-            # Rules mode: if GROUP_RULES_PATH is configured, use selective grouping only.
-            if GROUP_RULES_PATH:
-                group_rules = _load_group_rules()
-                assignment_key = _derive_assignment_key(configs, short_uuid, request)
-                transformed = _transform_configs_with_rules(
-                    configs,
-                    group_rules,
-                    assignment_key=assignment_key,
-                )
-                if transformed:
-                    return JSONResponse(content=transformed, headers=response_headers)
-                return JSONResponse(content=configs, headers=response_headers)
-
-            # Legacy mode: if no rules configured, merge all into one entry.
-            if len(configs) > 1:
-                mode = _normalize_group_mode(DEFAULT_GROUP_MODE)
-                if mode == "xray_balancer":
-                    balancer_config = build_balancer_config(
-                        configs,
-                        balancer_name=BALANCER_NAME,
-                        strategy=DEFAULT_BALANCER_STRATEGY,
-                        probe_url=PROBE_URL,
-                        probe_interval=PROBE_INTERVAL,
-                    )
-                    if balancer_config:
-                        return JSONResponse(
-                            content=[balancer_config], headers=response_headers
-                        )
-                else:
-                    assignment_key = _derive_assignment_key(configs, short_uuid, request)
-                    picked = _hrw_pick_config(
-                        configs,
-                        assignment_key=assignment_key,
-                        group_name=BALANCER_NAME,
-                    )
-                    grouped = copy.deepcopy(picked)
-                    grouped["remarks"] = BALANCER_NAME
-                    return JSONResponse(content=[grouped], headers=response_headers)
-
-            return JSONResponse(content=configs, headers=response_headers)
-
-        # Non-list JSON - return as is
+    # Only a JSON array can be grouped. Anything else (base64 links, a single
+    # JSON object) is returned without parsing or hashing the body.
+    m = JSON_FIRST_TOKEN_RE.search(body)
+    first = m.group() if m else b""
+    if first != b"[":
         return Response(
-            content=upstream_response.content,
-            media_type="application/json",
+            content=body,
+            media_type=(
+                "application/json"
+                if first == b"{"
+                else upstream_response.headers.get("content-type", "text/plain")
+            ),
             headers=response_headers,
         )
 
-    except json.JSONDecodeError:
-        # Not JSON - return as is
+    # Grouping needs at least two configs, and every config Remnawave renders
+    # carries a "remarks" key. Fewer than two occurrences means a solo-server
+    # subscription: nothing to merge, so skip the parse entirely.
+    if body.count(b'"remarks"') < 2:
         return Response(
-            content=upstream_response.content,
-            media_type=upstream_response.headers.get("content-type", "text/plain"),
+            content=body,
+            media_type="application/json",
             headers=response_headers,
         )
 
+    group_rules = _load_group_rules() if GROUP_RULES_PATH else []
+    fallback_key = short_uuid or (request.client.host if request.client else "")
+    # Happ clients poll the same body over and over; only re-render when the
+    # body, the user fallback key or the loaded rules file change.
+    cache_key = (
+        xxhash.xxh3_64_intdigest(body),
+        fallback_key,
+        _group_rules_cache["version"],
+    )
+    cached = _get_cached_transform(cache_key)
+    if cached is None:
+        if len(body) >= TRANSFORM_THREAD_MIN_BYTES:
+            # Parse/group/serialize is CPU-bound; keep the event loop serving
+            # other requests while a large subscription is rendered.
+            content, is_json = await asyncio.to_thread(
+                _render_happ_body, body, group_rules, fallback_key
+            )
+        else:
+            content, is_json = _render_happ_body(body, group_rules, fallback_key)
+        _cache_transform(cache_key, (None if content is body else content, is_json))
+    else:
+        content, is_json = cached
+        if content is None:
+            content = body
+
+    return Response(
+        content=content,
+        media_type=(
+            "application/json"
+            if is_json
+            else upstream_response.headers.get("content-type", "text/plain")
+        ),
+        headers=response_headers,
+    )
+
+
+# Registered before the generic two-segment route: Starlette matches routes in
+# registration order, so this one must come first to see /assets/... requests.
+@app.api_route("/assets/{path:path}", methods=["GET", "HEAD"])
+async def proxy_subscription_asset(path: str, request: Request):
+    """Proxy subscription-page static assets with the cached session cookie"""
+    client: httpx.AsyncClient = request.app.state.http
+    try:
+        headers = _build_upstream_request_headers(request)
+        _inject_cookie_if_missing(headers, _get_cached_asset_cookie())
+
+        upstream_response = await _request_upstream_with_retries(
+            client,
+            request.method,
+            _build_upstream_url(f"assets/{path}", request),
+            headers,
+            stream=True,
+        )
+    except Exception:
+        logger.exception(
+            "upstream request failed: %s %s", request.method, request.url.path
+        )
+        return UPSTREAM_ERROR_RESPONSE
+
+    return await _passthrough_response(upstream_response)
+
 
 @app.api_route("/{short_uuid}/{path:path}", methods=["GET", "HEAD"])
 async def proxy_subscription_path(short_uuid: str, path: str, request: Request):
     """Proxy other subscription paths without transformation"""
-    async with httpx.AsyncClient() as client:
-        try:
-            headers = _build_upstream_request_headers(request)
-            if short_uuid == "assets":
-                _inject_cookie_if_missing(headers, _get_cached_asset_cookie())
-
-            upstream_response = await _request_upstream_with_retries(
-                client,
-                request.method,
-                _build_upstream_url(f"{short_uuid}/{path}", request),
-                headers,
-            )
-            return Response(
-                content=upstream_response.content,
-                status_code=upstream_response.status_code,
-                media_type=upstream_response.headers.get("content-type"),
-                headers=_extract_passthrough_headers(upstream_response),
-            )
-        except Exception as e:
-            return Response(status_code=502, content=f"Upstream error: {e}")
+    client: httpx.AsyncClient = request.app.state.http
+    try:
+        headers = _build_upstream_request_headers(request)
+        upstream_response = await _request_upstream_with_retries(
+            client,
+            request.method,
+            _build_upstream_url(f"{short_uuid}/{path}", request),
+            headers,
+            stream=True,
+        )
+    except Exception:
+        logger.exception(
+            "upstream request failed: %s %s", request.method, request.url.path
+        )
+        return UPSTREAM_ERROR_RESPONSE
+
+    return await _passthrough_response(upstream_response)
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("APP_PORT", "3020"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Caches (asset cookie, rendered subscriptions) are per process, so extra
+    # workers are opt-in via WEB_CONCURRENCY.
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    # Import string form is required for multi-worker mode.
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+    )